@@ -1,111 +1,319 @@
+import sys
 from typing import Generator
 
-import networkx as nx
+# steps of the scheduling worklist
+_APPLY, _EMIT_DELETE, _DELETE, _RELEASE, _EMIT_CREATE, _CREATE = range(6)
+
+# edge labels of the predecessor map
+_DEP, _TOOL = range(2)
+
+# plans kept per planner, oldest specifier set evicted first
+_MAX_CACHED_PLANS = 32
 
 
 class ApplyPlanner:
     def __init__(self, state: dict, target: dict, changed: set[str]):
-        self._state = state
-        self._target = target
-        self._changed = changed or set()
-
-        self._delete_deps_graph = self._generate_delete_deps_graph()
-        self._tools_deps_graph = self._generate_tools_deps_graph()
+        self._state = {sys.intern(k): v for k, v in state.items()}
+        self._target = {sys.intern(k): v for k, v in target.items()}
+        self._changed = {sys.intern(c) for c in changed or ()}
+
+        self._preds = self._generate_preds()
+        self._succ = self._generate_succ()
+        self._neighbours = self._generate_neighbours()
+        self._plain_deletes = self._generate_plain_deletes()
+        self._create_steps = self._generate_create_steps()
+        self._delete_steps = self._generate_delete_steps()
+        self._default_specifiers = sorted(self._target.keys() | self._state.keys())
+        self._plus = {n: "+" + n for n in self._default_specifiers}
+        self._minus = {n: "-" + n for n in self._default_specifiers}
 
         self._applied = set()
+        self._applied_hash = 0
+        self._deleted = set()
+        self._deleting = {}
+        self._plan_ops = set()
+
+        self._validated = False
+        self._plans = {}
 
     def plan(self, specifiers: list[str] = None) -> Generator[str, None, None]:
-        self._validate_acyclic()
+        """Yield the plan operations for the given (or all) resources.
+
+        Plans are cached per specifier set for the lifetime of the planner, up to
+        the last 32 sets. The graphs are built from state, target and changed at
+        construction and the resources are not re-read, so build a new planner
+        once any of them (or a resource's deps or tools) changes.
+        """
+        key = tuple(sorted(specifiers)) if specifiers else None
+        if key not in self._plans:
+            if len(self._plans) >= _MAX_CACHED_PLANS:
+                del self._plans[next(iter(self._plans))]
+            self._plans[key] = self._build_plan(specifiers)
+
+        yield from self._plans[key]
+
+    def plan_levels(
+        self, specifiers: list[str] = None
+    ) -> Generator[list[str], None, None]:
+        plan = list(self.plan(specifiers))
+        position = {op: i for i, op in enumerate(plan)}
+
+        succ = self._generate_plan_succ(plan, position)
+        in_degree = dict.fromkeys(plan, 0)
+        for op in plan:
+            for s in succ[op]:
+                in_degree[s] += 1
+
+        ready = [op for op in plan if not in_degree[op]]
+        while ready:
+            yield ready
+
+            next_ready = []
+            for op in ready:
+                for s in succ[op]:
+                    in_degree[s] -= 1
+                    if not in_degree[s]:
+                        next_ready.append(s)
+
+            ready = sorted(next_ready, key=position.__getitem__)
+
+    def _generate_plan_succ(
+        self, plan: list[str], position: dict[str, int]
+    ) -> dict[str, dict[str, None]]:
+        # operations on the same or a directly related resource keep their plan
+        # order; everything else within a level may be applied concurrently.
+        # The order is not carried through resources without an operation in
+        # the plan
+        ops_of = {}
+        for op in plan:
+            ops_of.setdefault(op[1:], []).append(op)
+
+        succ = {op: {} for op in plan}
+        for name, ops in ops_of.items():
+            # at most "-name" then "+name"
+            for a, b in zip(ops, ops[1:]):
+                succ[a][b] = None
+
+            for n in self._neighbours.get(name, ()):
+                if n == name:
+                    continue
+                for a in ops:
+                    for b in ops_of.get(n, ()):
+                        if position[a] < position[b]:
+                            succ[a][b] = None
+                        else:
+                            succ[b][a] = None
+
+        return succ
+
+    def _build_plan(self, specifiers: list[str] = None) -> list[str]:
+        if not self._validated:
+            self._validate_acyclic()
+            self._validated = True
 
         self._applied.clear()
-        specifiers = sorted(specifiers or self._target.keys() | self._state.keys())
+        self._applied_hash = 0
+        self._deleted.clear()
+        self._deleting.clear()
+        self._plan_ops.clear()
+        specifiers = sorted(specifiers) if specifiers else self._default_specifiers
 
         plan = []
 
         for specifier in specifiers:
-            self._apply_resource(plan, specifier)
+            self._schedule(plan, specifier)
 
         for to_be_present in self._target:
-            if "-" + to_be_present in plan and not "+" + to_be_present in plan:
-                plan.append("+" + to_be_present)
+            minus, plus = self._minus[to_be_present], self._plus[to_be_present]
+            if minus in self._plan_ops and plus not in self._plan_ops:
+                self._emit(plan, plus)
 
-        visited = set()
-        for e in plan:
-            if e not in visited:
-                yield e
-            visited.add(e)
+        return plan
 
     def _validate_acyclic(self):
-        try:
-            if cycles := nx.find_cycle(
-                    nx.compose(self._delete_deps_graph, self._tools_deps_graph)
-            ):
-                raise ValueError(f"Detected cycles: {cycles}")
-        except nx.NetworkXNoCycle:
-            pass
-
-    def _apply_resource(self, plan: list[str], name: str):
-        if name in self._applied:
-            return
-
-        self._applied.add(name)
-
-        if name not in self._target:
-            self._plan_delete(plan, name)
-
-        elif self._is_changed(name):
-            self._plan_delete(plan, name)
-            self._plan_create(plan, name)
-
-        elif name not in self._state:
-            self._plan_create(plan, name)
-
-    def _is_changed(self, name: str) -> bool:
-        return name in self._changed
-
-    def _plan_create(self, plan: list[str], name: str):
-        assert name in self._target or name in self._state
-
-        try:
-            resource = self._target[name]
-        except KeyError:
-            resource = self._state[name]
-
-        for tool in resource.tools:
-            self._apply_resource(plan, tool)
-
-        for dep in resource.deps:
-            self._apply_resource(plan, dep)
-
-        plan.append("+" + name)
-
-    def _plan_delete(self, plan: list[str], name: str):
-        assert name in self._state
-
-        if name in self._tools_deps_graph:
-            for dependee_tool in self._tools_deps_graph.predecessors(name):
-                self._apply_resource(plan, dependee_tool)
-
-        for dependee in self._delete_deps_graph.predecessors(name):
-            self._plan_delete(plan, dependee)
+        # iterative three-color DFS: 0 = unvisited, 1 = on the path, 2 = done
+        color = dict.fromkeys(self._succ, 0)
+        for root in self._succ:
+            if color[root]:
+                continue
+
+            color[root] = 1
+            path = [root]
+            stack = [iter(self._succ[root])]
+            while stack:
+                for succ in stack[-1]:
+                    mark = color.get(succ, 0)
+                    if mark == 1:
+                        cycle = path[path.index(succ):] + [succ]
+                        raise ValueError(
+                            f"Detected cycles: {list(zip(cycle, cycle[1:]))}"
+                        )
+                    if mark == 0:
+                        color[succ] = 1
+                        path.append(succ)
+                        stack.append(iter(self._succ.get(succ, ())))
+                        break
+                else:
+                    color[path.pop()] = 2
+                    stack.pop()
+
+    def _schedule(self, plan: list[str], root: str):
+        # post-order walk with an explicit stack; steps are pushed in reverse
+        # so they pop in the order the planning rules list them. This is the
+        # hot loop, so the steps are inlined, dispatched roughly by how often
+        # they occur, and read the planner state through locals
+        applied, deleted, plan_ops = self._applied, self._deleted, self._plan_ops
+        state, target, changed = self._state, self._target, self._changed
+        plain_deletes, delete_steps = self._plain_deletes, self._delete_steps
+        deleting, applied_hash = self._deleting, self._applied_hash
+
+        stack = [(root, _APPLY)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            name, step = pop()
+            if step == _APPLY:
+                if name in applied:
+                    continue
+
+                applied.add(name)
+                applied_hash ^= hash(name)
+
+                if name not in target:
+                    push((name, _DELETE))
+
+                elif name in changed:
+                    push((name, _CREATE))
+                    push((name, _DELETE))
+
+                elif name not in state:
+                    push((name, _CREATE))
+
+            elif step == _EMIT_DELETE:
+                if name in plain_deletes:
+                    deleted.add(name)
+                else:
+                    deleting[name].pop()
+
+                op = self._minus[name]
+                if op not in plan_ops:
+                    plan.append(op)
+                    plan_ops.add(op)
+
+            elif step == _DELETE:
+                assert name in state
+
+                if name in plain_deletes:
+                    if name not in deleted:
+                        stack += delete_steps[name]
+                    continue
+
+                # a resource released for its tools may be deleted again while
+                # its outer delete is still pending; starting from the applied
+                # set another pending delete of it started from would repeat
+                # forever, so skip it. Applied sets are compared by size and
+                # the XOR of their name hashes
+                key = (len(applied), applied_hash)
+                pending = deleting.setdefault(name, [])
+                if key not in pending:
+                    pending.append(key)
+                    stack += delete_steps[name]
+
+            elif step == _RELEASE:
+                # let the resource be planned again for its tools
+                if name in applied:
+                    applied.remove(name)
+                    applied_hash ^= hash(name)
+
+            elif step == _EMIT_CREATE:
+                op = self._plus[name]
+                if op not in plan_ops:
+                    plan.append(op)
+                    plan_ops.add(op)
+
+            else:
+                assert name in target or name in state
+
+                stack += self._create_steps[name]
+
+        self._applied_hash = applied_hash
+
+    def _emit(self, plan: list[str], op: str):
+        if op not in self._plan_ops:
+            plan.append(op)
+            self._plan_ops.add(op)
+
+    def _generate_preds(self) -> dict[str, list[tuple[str, int]]]:
+        preds = {}
+        for name, r in self._state.items():
+            for d in r.deps:
+                preds.setdefault(d, []).append((name, _DEP))
+            for t in r.tools:
+                preds.setdefault(t, []).append((name, _TOOL))
 
-        for tool in self._state[name].tools:
-            self._applied.discard(name)
-            self._apply_resource(plan, tool)
+        # tool users first, each group in state order
+        for dependees in preds.values():
+            dependees.sort(key=lambda p: p[1], reverse=True)
 
-        plan.append("-" + name)
+        return preds
 
-    def _generate_delete_deps_graph(self) -> nx.DiGraph:
-        deps_graph = nx.DiGraph()
+    def _generate_succ(self) -> dict[str, list[str]]:
+        succ = {}
         for name, r in self._state.items():
-            deps_graph.add_node(name)
-            deps_graph.add_edges_from([(name, d) for d in r.deps])
-
-        return deps_graph
-
-    def _generate_tools_deps_graph(self) -> nx.DiGraph:
-        tools_graph = nx.DiGraph()
+            succ[name] = [*r.deps, *r.tools]
+
+        return succ
+
+    def _generate_neighbours(self) -> dict[str, dict[str, None]]:
+        neighbours = {}
+        for resources in (self._state, self._target):
+            for name, r in resources.items():
+                related = neighbours.setdefault(name, {})
+                related.update(dict.fromkeys([*r.deps, *r.tools]))
+
+        return neighbours
+
+    def _generate_plain_deletes(self) -> set[str]:
+        # deleting one of these only deletes its dependees, recursively, and
+        # never applies or releases anything through tools, so once planned it
+        # can only repeat operations that are already in the plan
+        pending = [
+            name
+            for name, r in self._state.items()
+            if r.tools or any(label == _TOOL for _, label in self._preds.get(name, ()))
+        ]
+        touches_tools = set(pending)
+        while pending:
+            for dep in self._state[pending.pop()].deps:
+                if dep in self._state and dep not in touches_tools:
+                    touches_tools.add(dep)
+                    pending.append(dep)
+
+        return self._state.keys() - touches_tools
+
+    def _generate_create_steps(self) -> dict[str, list[tuple[str, int]]]:
+        create_steps = {}
+        for resources in (self._state, self._target):
+            for name, r in resources.items():
+                create_steps[name] = [
+                    (name, _EMIT_CREATE),
+                    *((dep, _APPLY) for dep in reversed(r.deps)),
+                    *((tool, _APPLY) for tool in reversed(r.tools)),
+                ]
+
+        return create_steps
+
+    def _generate_delete_steps(self) -> dict[str, list[tuple[str, int]]]:
+        delete_steps = {}
         for name, r in self._state.items():
-            tools_graph.add_edges_from([(name, d) for d in r.tools])
-
-        return tools_graph
+            steps = [(name, _EMIT_DELETE)]
+            for tool in reversed(r.tools):
+                steps += [(tool, _APPLY), (name, _RELEASE)]
+
+            # tool users are applied before dependees are deleted
+            steps += [
+                (dependee, _APPLY if label == _TOOL else _DELETE)
+                for dependee, label in reversed(self._preds.get(name, ()))
+            ]
+            delete_steps[name] = steps
+
+        return delete_steps
@@ -1,27 +1,35 @@
+import sys
 import unittest
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 
 from apply_planner import ApplyPlanner
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class TR:
     name: str
-    deps: list[str] = field(default_factory=lambda: [])
-    tools: list[str] = field(default_factory=lambda: [])
+    deps: tuple[str, ...] = ()
+    tools: tuple[str, ...] = ()
 
 
 TEST_RESOURCES_1 = [
     TR("km-config"),
-    TR("km", deps=["km-config"]),
-    TR("pes-spool", tools=["km"]),
-    TR("pes", deps=["km", "pes-spool"]),
+    TR("km", deps=("km-config",)),
+    TR("pes-spool", tools=("km",)),
+    TR("pes", deps=("km", "pes-spool")),
+]
+
+TEST_RESOURCES_3 = [
+    TR("base"),
+    TR("a", deps=("base",)),
+    TR("b", deps=("base",)),
+    TR("c", deps=("a", "b")),
 ]
 
 TEST_RESOURCES_2 = [
     TR("adp-rpm"),
-    TR("database-permission-updater", deps=["adp-rpm"]),
-    TR("adp-config", tools=["database-permission-updater"], deps=["adp-rpm"]),
+    TR("database-permission-updater", deps=("adp-rpm",)),
+    TR("adp-config", tools=("database-permission-updater",), deps=("adp-rpm",)),
 ]
 
 
@@ -29,8 +37,8 @@ class GraphBuilderTestCase(unittest.TestCase):
     def test_acyclic(self):
         ap = self._build_apply_planner(
             [
-                TR("A", deps=["B"]),
-                TR("B", deps=["A"]),
+                TR("A", deps=("B",)),
+                TR("B", deps=("A",)),
             ]
         )
 
@@ -41,11 +49,36 @@ class GraphBuilderTestCase(unittest.TestCase):
             "Detected cycles: [('A', 'B'), ('B', 'A')]", str(err.exception)
         )
 
+    def test_acyclic_self_loop(self):
+        ap = self._build_apply_planner([TR("A", deps=("A",))])
+
+        with self.assertRaises(ValueError) as err:
+            list(ap.plan())
+
+        self.assertEqual("Detected cycles: [('A', 'A')]", str(err.exception))
+
+    def test_acyclic_through_tools(self):
+        ap = self._build_apply_planner(
+            [
+                TR("A", tools=("B",)),
+                TR("B", tools=("C",)),
+                TR("C", deps=("A",)),
+            ]
+        )
+
+        with self.assertRaises(ValueError) as err:
+            list(ap.plan())
+
+        self.assertEqual(
+            "Detected cycles: [('A', 'B'), ('B', 'C'), ('C', 'A')]",
+            str(err.exception),
+        )
+
     def test_tool_of_tool(self):
         ap = self._build_apply_planner(
             [
-                TR("needs-tool", tools=["tool1"]),
-                TR("tool1", tools=["tool2"]),
+                TR("needs-tool", tools=("tool1",)),
+                TR("tool1", tools=("tool2",)),
                 TR("tool2"),
             ],
             changed=["needs-tool", "tool1", "tool2"],
@@ -148,6 +181,129 @@ class GraphBuilderTestCase(unittest.TestCase):
             list(plan),
         )
 
+    def test_repeated_plan(self):
+        gb = self._build_apply_planner(
+            TEST_RESOURCES_1, changed=["km-config", "pes-spool"]
+        )
+
+        self.assertEqual(list(gb.plan()), list(gb.plan()))
+        self.assertEqual(
+            ["-pes", "-pes-spool", "+pes-spool", "+pes"], list(gb.plan(["pes-spool"]))
+        )
+        self.assertEqual(
+            [
+                "-pes",
+                "-pes-spool",
+                "+pes-spool",
+                "-km",
+                "-km-config",
+                "+km-config",
+                "+km",
+                "+pes",
+            ],
+            list(gb.plan()),
+        )
+
+    def test_levels_all_new(self):
+        gb = self._build_apply_planner(TEST_RESOURCES_3, all_new=True)
+
+        levels = gb.plan_levels()
+
+        self.assertEqual([["+base"], ["+a", "+b"], ["+c"]], list(levels))
+
+    def test_levels_all_removed(self):
+        gb = self._build_apply_planner(TEST_RESOURCES_3, all_removed=True)
+
+        levels = gb.plan_levels()
+
+        self.assertEqual([["-c"], ["-a", "-b"], ["-base"]], list(levels))
+
+    def test_levels_changed(self):
+        gb = self._build_apply_planner(TEST_RESOURCES_3, changed=["a", "b"])
+
+        levels = gb.plan_levels()
+
+        self.assertEqual([["-c"], ["-a", "-b"], ["+a", "+b"], ["+c"]], list(levels))
+
+    def test_levels_keep_tool_order(self):
+        gb = self._build_apply_planner(TEST_RESOURCES_1, changed=["pes-spool", "km"])
+
+        levels = gb.plan_levels()
+
+        self.assertEqual(
+            [["-pes"], ["-pes-spool"], ["+pes-spool"], ["-km"], ["+km"], ["+pes"]],
+            list(levels),
+        )
+
+    def test_levels_not_transitive(self):
+        # in the target c depends on a only through b, which is unchanged; with
+        # no operation on b nothing orders the operations on a and c
+        state = {r.name: r for r in [TR("a"), TR("b"), TR("c")]}
+        target = {
+            r.name: r for r in [TR("a"), TR("b", deps=("a",)), TR("c", deps=("b",))]
+        }
+        gb = ApplyPlanner(state, target, {"a", "c"})
+
+        levels = gb.plan_levels()
+
+        self.assertEqual([["-a", "-c"], ["+a", "+c"]], list(levels))
+
+    def test_deep_chain(self):
+        count = sys.getrecursionlimit() + 100
+        gb = self._build_apply_planner(
+            [TR("r0")] + [TR(f"r{i}", deps=(f"r{i - 1}",)) for i in range(1, count)],
+            all_new=True,
+        )
+
+        plan = gb.plan()
+
+        self.assertEqual([f"+r{i}" for i in range(count)], list(plan))
+
+    def test_all_removed_diamonds(self):
+        # every layer depends on both resources of the layer below; without
+        # reusing finished deletes the walk doubles with every layer
+        layers = 40
+        resources = [TR("00a"), TR("00b")]
+        for i in range(1, layers):
+            below = (f"{i - 1:02}a", f"{i - 1:02}b")
+            resources += [TR(f"{i:02}a", deps=below), TR(f"{i:02}b", deps=below)]
+        gb = self._build_apply_planner(resources, all_removed=True)
+
+        plan = gb.plan()
+
+        expected = []
+        for i in reversed(range(1, layers)):
+            expected += [f"-{i:02}a", f"-{i:02}b"]
+        self.assertEqual(expected + ["-00a", "-00b"], list(plan))
+
+    def test_reentered_delete_terminates(self):
+        # r1 to r4 are all released for their tools while their deletes are
+        # still pending, and deleting those tools reaches them again through
+        # tool users (r1, r2 use r0) and dependees (r4 on r3, r2 on r1); the
+        # recursive planner kept re-entering these deletes until it overflowed
+        state = {
+            r.name: r
+            for r in [
+                TR("r0"),
+                TR("r1", tools=("r0",)),
+                TR("r2", deps=("r1",), tools=("r0",)),
+                TR("r3", tools=("r2",)),
+                TR("r4", deps=("r3",), tools=("r1",)),
+            ]
+        }
+        target = {r.name: r for r in [TR("r0"), TR("r2"), TR("r4", tools=("r2",))]}
+        gb = ApplyPlanner(state, target, {"r0", "r2"})
+
+        plan = list(gb.plan())
+
+        # every state resource goes (r1 and r3 are removed, r0 and r2 changed,
+        # r4 depends on the removed r3) and every target resource comes back
+        self.assertEqual(len(plan), len(set(plan)))
+        self.assertEqual(
+            {f"-{name}" for name in state} | {f"+{name}" for name in target},
+            set(plan),
+        )
+
     @staticmethod
     def _build_apply_planner(
         resources: list[TR],